@@ -1,39 +1,62 @@
 import os
-import json
+import time
+import asyncio
+import hashlib
+import html
+import logging
 import secrets
-from typing import Optional, Dict, Any, List, Tuple
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Set, Tuple
 
-import psycopg2
-import psycopg2.extras
+import asyncpg
+import orjson
 
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse, PlainTextResponse, Response
+from fastapi.staticfiles import StaticFiles
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
 
+log = logging.getLogger(__name__)
+
 # =========================================================
 # ENV
 # =========================================================
 BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
 PUBLIC_BASE_URL = (os.getenv("PUBLIC_BASE_URL") or "").strip().rstrip("/")
-BOT_USERNAME = (os.getenv("BOT_USERNAME") or "YourBot").strip()  # without @
+BOT_USERNAME = (os.getenv("BOT_USERNAME") or "").strip().lstrip("@")  # fallback; real one comes from getMe
 PORT = int(os.getenv("PORT") or "10000")
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY") or "2")  # cpu_count() sees the host's cores in containers
 
-ADMIN_IDS = [int(x.strip()) for x in (os.getenv("ADMIN_IDS") or "").split(",") if x.strip().isdigit()]
+ADMIN_IDS = frozenset(int(x.strip()) for x in (os.getenv("ADMIN_IDS") or "").split(",") if x.strip().isdigit())
 
 DB_HOST = (os.getenv("DB_HOST") or "").strip()
 DB_PORT = int(os.getenv("DB_PORT") or "5432")
 DB_NAME = (os.getenv("DB_NAME") or "postgres").strip()
 DB_USER = (os.getenv("DB_USER") or "").strip()
 DB_PASS = (os.getenv("DB_PASS") or "").strip()
+# Postgres connections the whole deployment may hold; two deploys overlapping
+# during a restart must still fit under the server's max_connections (100)
+DB_CONN_BUDGET = int(os.getenv("DB_CONN_BUDGET") or "40")
+# per worker; each worker also keeps one LISTEN connection outside the pool
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX") or max(2, DB_CONN_BUDGET // WEB_CONCURRENCY - 1))
+DB_POOL_MIN = min(int(os.getenv("DB_POOL_MIN") or "2"), DB_POOL_MAX)
+# set when DB_HOST/DB_PORT point at PgBouncer in transaction pooling mode
+DB_PGBOUNCER = (os.getenv("DB_PGBOUNCER") or "").strip().lower() in ("1", "true", "yes")
+# LISTEN and migrations need a session, so under PgBouncer point these at Postgres itself
+DB_LISTEN_HOST = (os.getenv("DB_LISTEN_HOST") or DB_HOST).strip()
+DB_LISTEN_PORT = int(os.getenv("DB_LISTEN_PORT") or DB_PORT)
 
 
 def must_env(name: str, v: str):
@@ -50,21 +73,148 @@ must_env("DB_PASS", DB_PASS)
 # =========================================================
 # DB helpers
 # =========================================================
-def db_conn():
-    return psycopg2.connect(
-        host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASS
+DB_PARAMS = dict(
+    host=DB_HOST,
+    port=DB_PORT,
+    database=DB_NAME,
+    user=DB_USER,
+    password=DB_PASS,
+    # makes our sessions identifiable in pg_stat_activity
+    server_settings={"application_name": "refer-bot"},
+)
+
+db_pool: Optional[asyncpg.Pool] = None
+db_listener: Optional[asyncpg.Connection] = None
+
+
+async def init_conn(conn: asyncpg.Connection):
+    # jsonb columns come back as Python objects instead of strings
+    await conn.set_type_codec(
+        "jsonb",
+        encoder=lambda v: orjson.dumps(v).decode(),
+        decoder=orjson.loads,
+        schema="pg_catalog",
+        format="text",
     )
 
 
-def db_exec(query: str, params: tuple = (), fetchone=False, fetchall=False):
-    with db_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(query, params)
-            if fetchone:
-                return cur.fetchone()
-            if fetchall:
-                return cur.fetchall()
-            return None
+async def init_db():
+    global db_pool, db_listener
+    db_pool = await asyncpg.create_pool(
+        **DB_PARAMS,
+        init=init_conn,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        # prepared statements don't survive transaction pooling
+        statement_cache_size=0 if DB_PGBOUNCER else 1024,
+    )
+    # dedicated connection so other workers' set_setting() and chat_member
+    # updates drop our cached copies
+    db_listener = await asyncpg.connect(**{**DB_PARAMS, "host": DB_LISTEN_HOST, "port": DB_LISTEN_PORT})
+    await db_listener.add_listener("settings_changed", on_settings_changed)
+    await db_listener.add_listener("member_left", on_member_left)
+
+
+async def close_db():
+    global db_pool, db_listener
+    if db_listener:
+        await db_listener.close()
+        db_listener = None
+    if db_pool:
+        await db_pool.close()
+        db_pool = None
+
+
+async def db_exec(query: str, *args, fetchone=False, fetchall=False, fetchval=False):
+    async with db_pool.acquire() as conn:  # type: ignore
+        if fetchval:
+            return await conn.fetchval(query, *args)
+        if fetchone:
+            return await conn.fetchrow(query, *args)
+        if fetchall:
+            return await conn.fetch(query, *args)
+        return await conn.execute(query, *args)
+
+
+MIGRATION_LOCK_ID = 0x52454652  # advisory lock key for ensure_schema()
+
+
+def _index(name: str, definition: str) -> Tuple[str, List[str]]:
+    # a failed concurrent build leaves an invalid index behind; rebuild it then
+    return (
+        f"select not coalesce((select indisvalid from pg_index where indexrelid=to_regclass('{name}')), false)",
+        [f"drop index concurrently if exists {name}", f"create index concurrently {name} on {definition}"],
+    )
+
+
+# (is it needed?, statements); the check keeps routine boots away from table locks
+DB_MIGRATIONS: List[Tuple[str, List[str]]] = [
+    # stock_counts() and the ordered pick in redeem_coupon()
+    _index("coupons_unused_type_id", "coupons(coupon_type, id) where is_used=false"),
+    # token lookup in verify_on_web()
+    _index("users_verify_token", "users(verify_token) where verify_token is not null"),
+    (
+        """
+        select not exists (
+            select 1 from information_schema.columns
+            where table_schema=current_schema() and table_name='users' and column_name='verify_token_expires_at'
+        )
+        """,
+        ["alter table users add column if not exists verify_token_expires_at timestamptz"],
+    ),
+    # one-device-per-account check in verify_on_web()
+    _index("device_verifications_tg_id", "device_verifications(tg_id)"),
+    # redeem rules moved out of the settings.redeem_rules json blob
+    (
+        "select to_regclass('coupon_rules') is null",
+        ["create table if not exists coupon_rules(coupon_type text primary key, points int not null)"],
+    ),
+    # settings.redeem_rules is legacy and read-only: imported once, never read again
+    (
+        "select not exists (select 1 from coupon_rules)",
+        [
+            r"""
+            insert into coupon_rules(coupon_type, points)
+            select e.key, (e.value->>'points')::int
+            from settings s, jsonb_each(s.value) e
+            where s.key='redeem_rules' and jsonb_typeof(s.value)='object' and e.value->>'points' ~ '^\d+$'
+            on conflict (coupon_type) do nothing
+            """,
+        ],
+    ),
+]
+
+
+async def ensure_schema():
+    # every worker runs this at startup, however it was launched; the session
+    # lock makes them take turns and the catalog checks make the later turns
+    # no-ops. CONCURRENTLY needs a real session, so this connects past
+    # PgBouncer the same way the listener does.
+    conn = await asyncpg.connect(**{**DB_PARAMS, "host": DB_LISTEN_HOST, "port": DB_LISTEN_PORT})
+    try:
+        # poll rather than block: a session parked in pg_advisory_lock() is an open
+        # transaction, and CREATE INDEX CONCURRENTLY would wait on it forever
+        while not await conn.fetchval("select pg_try_advisory_lock($1)", MIGRATION_LOCK_ID):
+            await asyncio.sleep(1)
+        await conn.execute("set lock_timeout = '10s'")
+        for check, stmts in DB_MIGRATIONS:
+            if await conn.fetchval(check):
+                for stmt in stmts:
+                    await conn.execute(stmt)
+        await conn.executemany(
+            "insert into coupon_rules(coupon_type, points) values($1, $2) on conflict (coupon_type) do nothing",
+            list(DEFAULT_REDEEM_POINTS.items()),
+        )
+    finally:
+        await conn.close()  # also releases the advisory lock
+
+
+def rowcount(status: str) -> int:
+    # asyncpg returns the command tag, e.g. "DELETE 3"
+    try:
+        return int(status.rsplit(" ", 1)[-1])
+    except ValueError:
+        return 0
 
 
 def is_admin(uid: int) -> bool:
@@ -75,28 +225,61 @@ def is_admin(uid: int) -> bool:
 # settings (4 channels)
 # =========================================================
 FORCE_JOIN_COUNT = 3  # ✅ only 4 channels
+SETTINGS_TTL = 30  # seconds
 
+_settings_cache: Dict[str, Tuple[float, Any]] = {}
+_settings_lock = asyncio.Lock()
 
-def get_setting(key: str, default):
-    row = db_exec("select value from settings where key=%s", (key,), fetchone=True)
-    if not row:
+
+def clear_settings_cache(key: Optional[str] = None):
+    if key:
+        _settings_cache.pop(key, None)
+    else:
+        _settings_cache.clear()
+
+
+def on_settings_changed(conn, pid, channel, key):
+    clear_settings_cache(key)
+
+
+async def get_setting(key: str, default):
+    hit = _settings_cache.get(key)
+    if hit and time.monotonic() - hit[0] < SETTINGS_TTL:
+        value = hit[1]
+    else:
+        async with _settings_lock:
+            hit = _settings_cache.get(key)
+            if hit and time.monotonic() - hit[0] < SETTINGS_TTL:
+                value = hit[1]
+            else:
+                value = await db_exec("select value from settings where key=$1", key, fetchval=True)
+                _settings_cache[key] = (time.monotonic(), value)
+    if value is None:
         return default
-    return row["value"]
+    return value
 
 
-def set_setting(key: str, value):
-    db_exec(
-        """
-        insert into settings(key, value) values(%s, %s::jsonb)
-        on conflict (key) do update set value=excluded.value
-        """,
-        (key, json.dumps(value, ensure_ascii=False)),
-    )
+async def set_setting(key: str, value):
+    if key == "redeem_rules":
+        # the blob is only read by the one-time import into coupon_rules
+        raise ValueError("redeem_rules moved to the coupon_rules table; use set_redeem_points()")
+    async with db_pool.acquire() as conn:  # type: ignore
+        async with conn.transaction():
+            await conn.execute(
+                """
+                insert into settings(key, value) values($1, $2::jsonb)
+                on conflict (key) do update set value=excluded.value
+                """,
+                key,
+                value,
+            )
+            await conn.execute("select pg_notify('settings_changed', $1)", key)
+    clear_settings_cache(key)
 
 
-def get_force_channels() -> List[str]:
+async def get_force_channels() -> List[str]:
     default = ["@channel1", "@channel2", "@channel3"]
-    val = get_setting("force_join_channels", default)
+    val = await get_setting("force_join_channels", default)
 
     if isinstance(val, list):
         out = [str(x).strip() for x in val][:FORCE_JOIN_COUNT]
@@ -107,256 +290,408 @@ def get_force_channels() -> List[str]:
     return default
 
 
-def get_redeem_rules() -> Dict[str, Dict[str, int]]:
-    default = {
-        "500": {"points": 3},
-        "1000": {"points": 10},
-        "2000": {"points": 25},
-        "4000": {"points": 40},
-    }
-    val = get_setting("redeem_rules", default)
-    if isinstance(val, dict):
-        for k in default:
-            val.setdefault(k, {})
-            val[k].setdefault("points", default[k]["points"])
-        return val
-    return default
+COUPON_TYPES_ORDERED = ("500", "1000", "2000", "4000")  # display order
+COUPON_TYPES = frozenset(COUPON_TYPES_ORDERED)
+
+DEFAULT_REDEEM_POINTS = {"500": 3, "1000": 10, "2000": 25, "4000": 40}
+
+
+async def get_redeem_rules() -> Dict[str, Dict[str, int]]:
+    rows = await db_exec("select coupon_type, points from coupon_rules order by points", fetchall=True)
+    return {r["coupon_type"]: {"points": int(r["points"])} for r in rows}
+
+
+async def set_redeem_points(t: str, points: int):
+    await db_exec(
+        """
+        insert into coupon_rules(coupon_type, points) values($1, $2)
+        on conflict (coupon_type) do update set points=excluded.points
+        """,
+        t,
+        points,
+    )
+
+
+_COUPON_LABELS = {
+    "500": "500 off 500",
+    "1000": "1000 off 1000",
+    "2000": "2000 off 2000",
+    "4000": "4000 off 4000",
+}
 
 
 def coupon_label(t: str) -> str:
-    return {
-        "500": "500 off 500",
-        "1000": "1000 off 1000",
-        "2000": "2000 off 2000",
-        "4000": "4000 off 4000",
-    }.get(t, t)
+    return _COUPON_LABELS.get(t, t)
 
 
 # =========================================================
 # users
 # =========================================================
-def upsert_user(uid: int, username: Optional[str], first_name: Optional[str]):
-    db_exec(
-        """
-        insert into users(tg_id, username, first_name, last_seen)
-        values(%s, %s, %s, now())
-        on conflict (tg_id) do update set
-          username=excluded.username,
-          first_name=excluded.first_name,
-          last_seen=now()
-        """,
-        (uid, username, first_name),
-    )
+SEEN_TTL = 30  # seconds; last_seen is advisory
+SEEN_MAX = 10_000
+
+_seen: "OrderedDict[int, float]" = OrderedDict()
+
+# what the handlers read; keeps state_data and friends off the wire
+USER_COLUMNS = "tg_id, username, first_name, verified, referral_awarded, referred_by, points, referrals"
+
+
+async def upsert_and_get_user(uid: int, username: Optional[str], first_name: Optional[str]) -> Dict[str, Any]:
+    now = time.monotonic()
+    ts = _seen.get(uid)
+    if ts is not None and now - ts < SEEN_TTL:
+        # written moments ago; a read is enough unless the profile changed
+        row = await db_exec(f"select {USER_COLUMNS} from users where tg_id=$1", uid, fetchone=True)
+        if row and row["username"] == username and row["first_name"] == first_name:
+            return dict(row)
+
+    async with db_pool.acquire() as conn:  # type: ignore
+        # almost every update comes from a known user, so skip the conflict probe
+        row = await conn.fetchrow(
+            f"update users set username=$2, first_name=$3, last_seen=now() where tg_id=$1 returning {USER_COLUMNS}",
+            uid,
+            username,
+            first_name,
+        )
+        if row is None:
+            row = await conn.fetchrow(
+                f"""
+                insert into users(tg_id, username, first_name, last_seen)
+                values($1, $2, $3, now())
+                on conflict (tg_id) do update set
+                  username=excluded.username,
+                  first_name=excluded.first_name,
+                  last_seen=now()
+                returning {USER_COLUMNS}
+                """,
+                uid,
+                username,
+                first_name,
+            )
 
+    _seen[uid] = now
+    _seen.move_to_end(uid)
+    while len(_seen) > SEEN_MAX:
+        _seen.popitem(last=False)
+    return dict(row)
 
-def get_user(uid: int) -> Optional[Dict[str, Any]]:
-    return db_exec("select * from users where tg_id=%s", (uid,), fetchone=True)
 
+async def get_user(uid: int) -> Optional[Dict[str, Any]]:
+    row = await db_exec(f"select {USER_COLUMNS} from users where tg_id=$1", uid, fetchone=True)
+    return dict(row) if row else None
 
-def set_state(uid: int, state: Optional[str], state_data: Optional[Dict[str, Any]] = None):
-    db_exec(
-        "update users set state=%s, state_data=%s::jsonb where tg_id=%s",
-        (state, json.dumps(state_data, ensure_ascii=False) if state_data else None, uid),
+
+async def set_state(uid: int, state: Optional[str], state_data: Optional[Dict[str, Any]] = None):
+    await db_exec(
+        "update users set state=$1, state_data=$2::jsonb where tg_id=$3",
+        state,
+        state_data or None,
+        uid,
     )
 
 
-def clear_state(uid: int):
-    set_state(uid, None, None)
+async def clear_state(uid: int):
+    await set_state(uid, None, None)
 
 
 def safe_name(u: Dict[str, Any]) -> str:
+    # escaped for parse_mode="HTML"; a stray "<" in a name would fail the send
     if u.get("first_name"):
-        return str(u["first_name"])
+        return html.escape(str(u["first_name"]), quote=False)
     if u.get("username"):
-        return "@" + str(u["username"])
+        return "@" + html.escape(str(u["username"]), quote=False)
     return str(u.get("tg_id", ""))
 
 
 # =========================================================
 # referral award ONLY after verified
 # =========================================================
-def set_referred_by_if_needed(new_uid: int, ref_uid: int):
+async def set_referred_by_if_needed(new_uid: int, ref_uid: int):
     if new_uid == ref_uid:
         return
-    row = db_exec("select referred_by from users where tg_id=%s", (new_uid,), fetchone=True)
-    if not row or row["referred_by"] is not None:
-        return
-    db_exec("update users set referred_by=%s where tg_id=%s", (ref_uid, new_uid))
-
-
-def award_referral_if_applicable(new_uid: int) -> Optional[int]:
-    u = get_user(new_uid)
-    if not u or not u.get("verified") or u.get("referral_awarded") or not u.get("referred_by"):
-        return None
+    await db_exec(
+        "update users set referred_by=$1 where tg_id=$2 and referred_by is null",
+        ref_uid,
+        new_uid,
+    )
 
-    ref = int(u["referred_by"])
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "update users set referral_awarded=true where tg_id=%s and referral_awarded=false",
-                (new_uid,),
-            )
-            if cur.rowcount <= 0:
-                return None
-            cur.execute("update users set points=points+1, referrals=referrals+1 where tg_id=%s", (ref,))
-    return ref
+async def award_referral_if_applicable(new_uid: int) -> Optional[int]:
+    # flag + referrer credit in one statement; the where clause makes it idempotent
+    ref = await db_exec(
+        """
+        with upd as (
+            update users set referral_awarded=true
+            where tg_id=$1 and verified=true and referral_awarded=false and referred_by is not null
+            returning referred_by
+        ), bump as (
+            update users set points=points+1, referrals=referrals+1
+            where tg_id in (select referred_by from upd)
+        )
+        select referred_by from upd
+        """,
+        new_uid,
+        fetchval=True,
+    )
+    return int(ref) if ref else None
 
 
 # =========================================================
 # force join check (4 channels)
 # =========================================================
+MEMBER_CACHE_TTL = 60  # seconds
+MEMBER_CACHE_MAX = 50_000
+
+# (channel, uid) -> (checked_at, status); only joined statuses are kept so a
+# user who joins right after a failed check is re-checked immediately
+_member_cache: "OrderedDict[Tuple[str, int], Tuple[float, str]]" = OrderedDict()
+
+
+def evict_member(chat_ref: str, uid: int):
+    _member_cache.pop((chat_ref.lower(), uid), None)
+
+
+def on_member_left(conn, pid, channel, payload):
+    # "<uid> <chat_ref> [<chat_ref>]", sent by on_chat_member() in any worker
+    uid, *refs = payload.split()
+    for ref in refs:
+        evict_member(ref, int(uid))
+
+
 async def check_force_join(app: Application, uid: int) -> Tuple[bool, List[str], List[str]]:
-    channels = get_force_channels()
+    channels = await get_force_channels()
+    to_check = [ch.strip() for ch in channels if ch.strip()]
+
+    now = time.monotonic()
+    to_fetch = []
+    for ch in to_check:
+        key = (ch.lower(), uid)
+        hit = _member_cache.get(key)
+        if not hit or now - hit[0] >= MEMBER_CACHE_TTL:
+            to_fetch.append(ch)
+        else:
+            _member_cache.move_to_end(key)
+
+    results = await asyncio.gather(
+        *[app.bot.get_chat_member(chat_id=ch, user_id=uid) for ch in to_fetch],
+        return_exceptions=True,
+    )
+    fetched = dict(zip(to_fetch, results))
+
     not_joined = []
-    for ch in channels:
-        ch = ch.strip()
-        if not ch:
+    for ch in to_check:
+        if ch not in fetched:
             continue
-        try:
-            mem = await app.bot.get_chat_member(chat_id=ch, user_id=uid)
-            if mem.status in ("left", "kicked"):
-                not_joined.append(ch)
-        except Exception:
+        mem = fetched[ch]
+        if isinstance(mem, BaseException) or mem.status in ("left", "kicked"):
             not_joined.append(ch)
+        else:
+            key = (ch.lower(), uid)
+            _member_cache[key] = (now, mem.status)
+            _member_cache.move_to_end(key)
+    while len(_member_cache) > MEMBER_CACHE_MAX:
+        _member_cache.popitem(last=False)
     return (len(not_joined) == 0, channels, not_joined)
 
 
 # =========================================================
 # coupons
 # =========================================================
-def stock_counts() -> Dict[str, int]:
-    out = {}
-    for t in ["500", "1000", "2000", "4000"]:
-        row = db_exec(
-            "select count(*) c from coupons where coupon_type=%s and is_used=false",
-            (t,),
-            fetchone=True,
-        )
-        out[t] = int(row["c"]) if row else 0
+async def stock_counts() -> Dict[str, int]:
+    out = {t: 0 for t in COUPON_TYPES_ORDERED}
+    rows = await db_exec(
+        """
+        select coupon_type, count(*) c from coupons
+        where is_used=false and coupon_type = any($1::text[])
+        group by coupon_type
+        """,
+        list(out),
+        fetchall=True,
+    )
+    for r in rows:
+        out[r["coupon_type"]] = int(r["c"])
     return out
 
 
-def add_coupons(t: str, codes: List[str]) -> int:
-    if t not in ["500", "1000", "2000", "4000"]:
+async def add_coupons(t: str, codes: List[str]) -> int:
+    if t not in COUPON_TYPES:
         return 0
     cleaned = [c.strip() for c in codes if c.strip()]
     if not cleaned:
         return 0
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            for code in cleaned:
-                cur.execute(
-                    "insert into coupons(coupon_type, code, is_used) values(%s, %s, false)",
-                    (t, code),
-                )
+    async with db_pool.acquire() as conn:  # type: ignore
+        await conn.copy_records_to_table(
+            "coupons",
+            records=[(t, code, False) for code in cleaned],
+            columns=["coupon_type", "code", "is_used"],
+        )
     return len(cleaned)
 
 
-def remove_unused_coupons(t: str, count: int) -> int:
-    if t not in ["500", "1000", "2000", "4000"] or count <= 0:
+async def remove_unused_coupons(t: str, count: int) -> int:
+    if t not in COUPON_TYPES or count <= 0:
         return 0
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                delete from coupons
-                where id in (
-                    select id from coupons
-                    where coupon_type=%s and is_used=false
-                    order by id asc
-                    limit %s
-                )
-                """,
-                (t, count),
-            )
-            return cur.rowcount
+    status = await db_exec(
+        """
+        delete from coupons
+        where id in (
+            select id from coupons
+            where coupon_type=$1 and is_used=false
+            order by id asc
+            limit $2
+            for update skip locked
+        )
+        """,
+        t,
+        count,
+    )
+    return rowcount(status)
 
 
-def redeem_coupon(uid: int, t: str) -> Tuple[bool, str, int]:
-    if t not in ["500", "1000", "2000", "4000"]:
+async def redeem_coupon(uid: int, t: str) -> Tuple[bool, str, int]:
+    if t not in COUPON_TYPES:
         return (False, "Invalid option.", 0)
 
-    u = get_user(uid)
-    if not u:
+    # one round-trip: the coupon is only marked used if the points were taken
+    row = await db_exec(
+        """
+        with usr as (
+            select verified, points from users where tg_id=$2
+        ),
+        rule as (
+            select points from coupon_rules where coupon_type=$1
+        ),
+        picked as (
+            select id, code from coupons
+            where coupon_type=$1 and is_used=false
+              and (select verified from usr) and (select points from usr) >= (select points from rule)
+            order by id asc
+            limit 1
+            for update skip locked
+        ),
+        upd_u as (
+            update users set points=points-(select points from rule)
+            where tg_id=$2 and points>=(select points from rule) and exists (select 1 from picked)
+            returning tg_id
+        ),
+        upd_c as (
+            update coupons set is_used=true, used_by=$2, used_at=now()
+            where id=(select id from picked) and exists (select 1 from upd_u)
+            returning code
+        ),
+        ins as (
+            insert into redeems(tg_id, coupon_type, coupon_code, points_spent)
+            select $2, $1, code, (select points from rule) from upd_c
+        )
+        select (select code from upd_c) as code,
+               exists (select 1 from picked) as in_stock,
+               (select points from rule) as need,
+               (select verified from usr) as verified,
+               (select points from usr) as points
+        """,
+        t,
+        uid,
+        fetchone=True,
+    )
+    if row["verified"] is None:
         return (False, "User not found.", 0)
-    if not u.get("verified"):
+    if not row["verified"]:
         return (False, "Please verify first.", 0)
-
-    rules = get_redeem_rules()
-    need = int(rules.get(t, {}).get("points", 999999))
-
-    if int(u.get("points", 0)) < need:
-        return (False, f"Not enough points.\nRequired: {need}\nYou have: {u.get('points', 0)}", 0)
-
-    with db_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(
-                """
-                select id, code from coupons
-                where coupon_type=%s and is_used=false
-                order by id asc
-                limit 1
-                for update
-                """,
-                (t,),
-            )
-            row = cur.fetchone()
-            if not row:
-                return (False, f"Out of stock for {coupon_label(t)}", 0)
-
-            coupon_id = int(row["id"])
-            code = row["code"]
-
-            cur.execute("update coupons set is_used=true, used_by=%s, used_at=now() where id=%s", (uid, coupon_id))
-            cur.execute("update users set points=points-%s where tg_id=%s", (need, uid))
-            cur.execute(
-                "insert into redeems(tg_id, coupon_type, coupon_code, points_spent) values(%s,%s,%s,%s)",
-                (uid, t, code, need),
-            )
-    return (True, code, need)
+    if row["need"] is None:
+        return (False, "Invalid option.", 0)
+    need = int(row["need"])
+    if row["points"] < need:
+        return (False, f"Not enough points.\nRequired: {need}\nYou have: {row['points']}", 0)
+    if not row["in_stock"]:
+        return (False, f"Out of stock for {coupon_label(t)}", 0)
+    if row["code"] is None:
+        return (False, f"Not enough points.\nRequired: {need}", 0)
+    return (True, row["code"], need)
 
 
 # =========================================================
 # web verification (device lock)
 # =========================================================
-def create_verify_token(uid: int) -> str:
+VERIFY_TOKEN_TTL = 30 * 60  # seconds
+VERIFY_TOKEN_MIN_LEFT = VERIFY_TOKEN_TTL // 4  # don't hand out a link that is about to expire
+
+_LIVE_TOKEN_SQL = """
+    select verify_token from users
+    where tg_id=$1 and verify_token_expires_at > now() + make_interval(secs => $2)
+"""
+
+
+async def create_verify_token(uid: int) -> str:
+    # repeat clicks reuse the current token while it has a useful life left
+    current = await db_exec(_LIVE_TOKEN_SQL, uid, VERIFY_TOKEN_MIN_LEFT, fetchval=True)
+    if current:
+        return current
+
     token = secrets.token_urlsafe(24)
-    db_exec("update users set verify_token=%s where tg_id=%s", (token, uid))
-    return token
+    # the where clause is re-checked against the locked row, so if a concurrent
+    # click already issued a fresh token this matches nothing
+    current = await db_exec(
+        """
+        update users set verify_token=$2, verify_token_expires_at=now() + make_interval(secs => $3)
+        where tg_id=$1
+          and (verify_token is null or verify_token_expires_at is null
+               or verify_token_expires_at <= now() + make_interval(secs => $4))
+        returning verify_token
+        """,
+        uid,
+        token,
+        VERIFY_TOKEN_TTL,
+        VERIFY_TOKEN_MIN_LEFT,
+        fetchval=True,
+    )
+    if current:
+        return current
+
+    # lost that race; a new statement sees the winner's committed token
+    current = await db_exec(_LIVE_TOKEN_SQL, uid, VERIFY_TOKEN_MIN_LEFT, fetchval=True)
+    return current or token
 
 
-def verify_on_web(token: str, device_id: str) -> Tuple[bool, str, Optional[int]]:
+async def verify_on_web(token: str, device_id: str) -> Tuple[bool, str, Optional[int]]:
     token = (token or "").strip()
     device_id = (device_id or "").strip()
     if not token or not device_id:
         return (False, "Missing token/device.", None)
 
-    u = db_exec("select tg_id from users where verify_token=%s", (token,), fetchone=True)
-    if not u:
+    row = await db_exec(
+        """
+        select u.tg_id,
+               (select d.tg_id from device_verifications d where d.device_id=$2) as owner,
+               (select d.device_id from device_verifications d where d.tg_id=u.tg_id limit 1) as bound
+        from users u
+        where u.verify_token=$1 and (u.verify_token_expires_at is null or u.verify_token_expires_at > now())
+        """,
+        token,
+        device_id,
+        fetchone=True,
+    )
+    if not row:
         return (False, "Invalid or expired token.", None)
 
-    tg_id = int(u["tg_id"])
-
-    d = db_exec("select tg_id from device_verifications where device_id=%s", (device_id,), fetchone=True)
-    if d and int(d["tg_id"]) != tg_id:
+    tg_id = int(row["tg_id"])
+    if row["owner"] is not None and row["owner"] != tg_id:
         return (False, "This device is already verified with another account.", tg_id)
-
-    d2 = db_exec("select device_id from device_verifications where tg_id=%s", (tg_id,), fetchone=True)
-    if d2 and str(d2.get("device_id")) != device_id:
+    if row["bound"] is not None and row["bound"] != device_id:
         return (False, "This Telegram ID is already verified on a different device.", tg_id)
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("update users set verified=true where tg_id=%s", (tg_id,))
-            cur.execute(
-                """
-                insert into device_verifications(device_id, tg_id)
-                values(%s, %s)
-                on conflict (device_id) do update set tg_id=excluded.tg_id, verified_at=now()
-                """,
-                (device_id, tg_id),
-            )
+    # one statement is its own transaction: both writes land or neither does
+    await db_exec(
+        """
+        with v as (
+            update users set verified=true where tg_id=$2
+        )
+        insert into device_verifications(device_id, tg_id)
+        values($1, $2)
+        on conflict (device_id) do update set tg_id=excluded.tg_id, verified_at=now()
+        """,
+        device_id,
+        tg_id,
+    )
 
     return (True, "Verified successfully. Now go back to Telegram and click Check Verification.", tg_id)
 
@@ -364,14 +699,24 @@ def verify_on_web(token: str, device_id: str) -> Tuple[bool, str, Optional[int]]
 # =========================================================
 # Keyboards
 # =========================================================
+# channels only change on admin edits; markups are immutable so one can be shared
+_join_kb_cache: Optional[Tuple[Tuple[str, ...], InlineKeyboardMarkup]] = None
+
+
 def kb_join_channels(channels: List[str]) -> InlineKeyboardMarkup:
+    global _join_kb_cache
+    key = tuple(channels)
+    if _join_kb_cache and _join_kb_cache[0] == key:
+        return _join_kb_cache[1]
     rows = []
     for ch in channels:
         ch = ch.strip()
         if ch:
             rows.append([InlineKeyboardButton(f"Join {ch}", url="https://t.me/" + ch.lstrip("@"))])
     rows.append([InlineKeyboardButton("✅ Joined All Channels", callback_data="joined_all")])
-    return InlineKeyboardMarkup(rows)
+    kb = InlineKeyboardMarkup(rows)
+    _join_kb_cache = (key, kb)
+    return kb
 
 
 def kb_verify_actions(verify_url: str) -> InlineKeyboardMarkup:
@@ -381,42 +726,58 @@ def kb_verify_actions(verify_url: str) -> InlineKeyboardMarkup:
     ])
 
 
+_USER_MENU_ROWS = [
+    [InlineKeyboardButton("📊 Stats", callback_data="stats"),
+     InlineKeyboardButton("🏆 Leaderboard", callback_data="leaderboard")],
+    [InlineKeyboardButton("🎟️ Redeem", callback_data="redeem_menu"),
+     InlineKeyboardButton("🔗 Referral Link", callback_data="ref_link")],
+]
+_USER_MENU_PLAIN = InlineKeyboardMarkup(_USER_MENU_ROWS)
+_USER_MENU_ADMIN = InlineKeyboardMarkup(
+    _USER_MENU_ROWS + [[InlineKeyboardButton("🛠 Admin Panel", callback_data="admin_panel")]]
+)
+
+
 def user_menu(uid: int) -> InlineKeyboardMarkup:
-    rows = [
-        [InlineKeyboardButton("📊 Stats", callback_data="stats"),
-         InlineKeyboardButton("🏆 Leaderboard", callback_data="leaderboard")],
-        [InlineKeyboardButton("🎟️ Redeem", callback_data="redeem_menu"),
-         InlineKeyboardButton("🔗 Referral Link", callback_data="ref_link")],
-    ]
-    if is_admin(uid):
-        rows.append([InlineKeyboardButton("🛠 Admin Panel", callback_data="admin_panel")])
-    return InlineKeyboardMarkup(rows)
+    return _USER_MENU_ADMIN if is_admin(uid) else _USER_MENU_PLAIN
 
 
 # =========================================================
 # Text builders
 # =========================================================
-def join_text() -> str:
-    return "📢 <b>Join these channels first</b>\n\nAfter joining, click <b>✅ Joined All Channels</b>."
+_bot_username: Optional[str] = None  # filled from getMe at startup
+
+
+def get_bot_username() -> str:
+    return _bot_username or BOT_USERNAME or "YourBot"
+
+
+def referral_link(uid: int) -> str:
+    return f"https://t.me/{get_bot_username()}?start={uid}"
+
+
+_VERIFY_URL_PREFIX = f"{PUBLIC_BASE_URL}/verify?token="
+
+_JOIN_TEXT = "📢 <b>Join these channels first</b>\n\nAfter joining, click <b>✅ Joined All Channels</b>."
 
+_VERIFY_TEXT = "✅ <b>Great!</b>\nNow verify on website:\n\n1) Click <b>🔐 Verify</b>\n2) Complete verification\n3) Come back and click <b>✅ Check Verification</b>"
 
-def verify_text() -> str:
-    return "✅ <b>Great!</b>\nNow verify on website:\n\n1) Click <b>🔐 Verify</b>\n2) Complete verification\n3) Come back and click <b>✅ Check Verification</b>"
+
+_WELCOME_PREFIX = (
+    "🎉 <b>WELCOME!</b>\n\n"
+    "Use the menu below 👇\n\n"
+    "🔗 Your Referral Link:\n<code>"
+)
 
 
 def welcome_text(uid: int) -> str:
-    link = f"https://t.me/{BOT_USERNAME}?start={uid}"
-    return (
-        "🎉 <b>WELCOME!</b>\n\n"
-        "Use the menu below 👇\n\n"
-        f"🔗 Your Referral Link:\n<code>{link}</code>"
-    )
+    return "".join((_WELCOME_PREFIX, referral_link(uid), "</code>"))
 
 
-def stats_text(uid: int) -> str:
-    u = get_user(uid) or {}
+def stats_text(u: Dict[str, Any]) -> str:
+    uid = u["tg_id"]
     verified = "✅ Verified" if u.get("verified") else "❌ Not Verified"
-    link = f"https://t.me/{BOT_USERNAME}?start={uid}"
+    link = referral_link(uid)
     return (
         "📊 <b>Your Stats</b>\n\n"
         f"Status: <b>{verified}</b>\n"
@@ -427,19 +788,59 @@ def stats_text(uid: int) -> str:
     )
 
 
+# =========================================================
+# per-user rate limit (token bucket)
+# =========================================================
+RATE_PER_SEC = 2.0
+RATE_BURST = 5.0
+RATE_BUCKETS_MAX = 50_000
+
+_buckets: "OrderedDict[int, Tuple[float, float]]" = OrderedDict()  # uid -> (tokens, last_refill)
+
+
+def allow_update(uid: int) -> bool:
+    now = time.monotonic()
+    tokens, last = _buckets.get(uid, (RATE_BURST, now))
+    tokens = min(RATE_BURST, tokens + (now - last) * RATE_PER_SEC)
+    allowed = tokens >= 1
+    _buckets[uid] = (tokens - 1 if allowed else tokens, now)
+    _buckets.move_to_end(uid)
+    # the least recently seen bucket has long refilled, which is the same as no bucket
+    while len(_buckets) > RATE_BUCKETS_MAX:
+        _buckets.popitem(last=False)
+    return allowed
+
+
 # =========================================================
 # Telegram handlers (flow)
 # =========================================================
+async def send_quietly(bot, chat_id: int, text: str):
+    try:
+        await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+    except Exception:
+        pass
+
+
+async def edit_quietly(q: CallbackQuery, text: str, **kwargs):
+    # repeat taps re-render the same screen (the verify link is reused while it is
+    # live); Telegram rejects that edit, and the tap is already answered
+    try:
+        await q.edit_message_text(text, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    upsert_user(uid, update.effective_user.username, update.effective_user.first_name)
+    await upsert_and_get_user(uid, update.effective_user.username, update.effective_user.first_name)
 
     if context.args and context.args[0].isdigit():
-        set_referred_by_if_needed(uid, int(context.args[0]))
+        await set_referred_by_if_needed(uid, int(context.args[0]))
 
-    channels = get_force_channels()
+    channels = await get_force_channels()
     await update.message.reply_text(
-        join_text(),
+        _JOIN_TEXT,
         parse_mode="HTML",
         reply_markup=kb_join_channels(channels),
         disable_web_page_preview=True,
@@ -448,90 +849,156 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    upsert_user(uid, update.effective_user.username, update.effective_user.first_name)
+    if not allow_update(uid):
+        return
+    await upsert_and_get_user(uid, update.effective_user.username, update.effective_user.first_name)
     await update.message.reply_text("Use buttons 👇", reply_markup=user_menu(uid))
 
 
-async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    uid = q.from_user.id
-    upsert_user(uid, q.from_user.username, q.from_user.first_name)
-    data = q.data or ""
-    await q.answer()
+async def cb_joined_all(q: CallbackQuery, u: Dict[str, Any], context: ContextTypes.DEFAULT_TYPE):
+    uid = u["tg_id"]
+    all_joined, channels, _ = await check_force_join(context.application, uid)
+    if not all_joined:
+        await edit_quietly(
+            q,
+            "⚠️ <b>You still haven't joined all channels</b>\n\nPlease join and click again.",
+            parse_mode="HTML",
+            reply_markup=kb_join_channels(channels),
+        )
+        return
 
-    if data == "joined_all":
-        all_joined, channels, _ = await check_force_join(context.application, uid)
-        if not all_joined:
-            await q.edit_message_text(
-                "⚠️ <b>You still haven't joined all channels</b>\n\nPlease join and click again.",
-                parse_mode="HTML",
-                reply_markup=kb_join_channels(channels),
-            )
-            return
+    token = await create_verify_token(uid)
+    verify_url = _VERIFY_URL_PREFIX + token
 
-        token = create_verify_token(uid)
-        verify_url = f"{PUBLIC_BASE_URL}/verify?token={token}"
+    await context.application.bot.send_message(
+        chat_id=q.message.chat_id,
+        text=_VERIFY_TEXT,
+        parse_mode="HTML",
+        reply_markup=kb_verify_actions(verify_url),
+        disable_web_page_preview=True,
+    )
+
+
+async def cb_check_verification(q: CallbackQuery, u: Dict[str, Any], context: ContextTypes.DEFAULT_TYPE):
+    uid = u["tg_id"]
+    all_joined, channels, _ = await check_force_join(context.application, uid)
+    if not all_joined:
+        await edit_quietly(
+            q,
+            "⚠️ <b>You haven't joined all channels.</b>\n\nJoin and click Joined All Channels.",
+            parse_mode="HTML",
+            reply_markup=kb_join_channels(channels),
+        )
+        return
 
-        await context.application.bot.send_message(
-            chat_id=q.message.chat_id,
-            text=verify_text(),
+    if not u.get("verified"):
+        token = await create_verify_token(uid)
+        verify_url = _VERIFY_URL_PREFIX + token
+        await edit_quietly(
+            q,
+            "❌ <b>Not verified yet.</b>\n\nClick Verify and complete it, then click Check Verification.",
             parse_mode="HTML",
             reply_markup=kb_verify_actions(verify_url),
-            disable_web_page_preview=True,
         )
         return
 
-    if data == "check_verification":
-        all_joined, channels, _ = await check_force_join(context.application, uid)
-        if not all_joined:
-            await q.edit_message_text(
-                "⚠️ <b>You haven't joined all channels.</b>\n\nJoin and click Joined All Channels.",
-                parse_mode="HTML",
-                reply_markup=kb_join_channels(channels),
-            )
-            return
-
-        u = get_user(uid) or {}
-        if not u.get("verified"):
-            token = create_verify_token(uid)
-            verify_url = f"{PUBLIC_BASE_URL}/verify?token={token}"
-            await q.edit_message_text(
-                "❌ <b>Not verified yet.</b>\n\nClick Verify and complete it, then click Check Verification.",
-                parse_mode="HTML",
-                reply_markup=kb_verify_actions(verify_url),
+    ref_id = await award_referral_if_applicable(uid)
+    if ref_id:
+        # don't make the verifying user wait on the referrer's chat
+        context.application.create_task(
+            send_quietly(
+                context.application.bot,
+                ref_id,
+                f"✅ <b>Referral Added!</b>\nYou got <b>+1</b> point because <b>{safe_name(u)}</b> verified.",
             )
-            return
-
-        ref_id = award_referral_if_applicable(uid)
-        if ref_id:
-            try:
-                await context.application.bot.send_message(
-                    chat_id=ref_id,
-                    text=f"✅ <b>Referral Added!</b>\nYou got <b>+1</b> point because <b>{safe_name(u)}</b> verified.",
-                    parse_mode="HTML",
-                )
-            except Exception:
-                pass
-
-        await q.edit_message_text(welcome_text(uid), parse_mode="HTML", reply_markup=user_menu(uid))
+        )
+
+    await edit_quietly(q, welcome_text(uid), parse_mode="HTML", reply_markup=user_menu(uid))
+
+
+async def cb_stats(q: CallbackQuery, u: Dict[str, Any], context: ContextTypes.DEFAULT_TYPE):
+    await edit_quietly(q, stats_text(u), parse_mode="HTML", reply_markup=user_menu(u["tg_id"]))
+
+
+async def cb_ref_link(q: CallbackQuery, u: Dict[str, Any], context: ContextTypes.DEFAULT_TYPE):
+    uid = u["tg_id"]
+    link = referral_link(uid)
+    await edit_quietly(q, f"🔗 <b>Your Referral Link</b>\n\n<code>{link}</code>", parse_mode="HTML", reply_markup=user_menu(uid))
+
+
+CALLBACK_ROUTES = {
+    "joined_all": cb_joined_all,
+    "check_verification": cb_check_verification,
+    "stats": cb_stats,
+    "ref_link": cb_ref_link,
+}
+
+# routes that hit Telegram per channel; one in flight per user
+SERIAL_CALLBACKS = frozenset({"joined_all", "check_verification"})
+_busy_users: Set[int] = set()
+
+
+async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    uid = q.from_user.id
+    if not allow_update(uid):
+        await q.answer("Slow down", show_alert=False)
         return
+    u = await upsert_and_get_user(uid, q.from_user.username, q.from_user.first_name)
+    await q.answer()
 
-    if data == "stats":
-        await q.edit_message_text(stats_text(uid), parse_mode="HTML", reply_markup=user_menu(uid))
+    handler = CALLBACK_ROUTES.get(q.data or "")
+    if not handler:
         return
+    if q.data not in SERIAL_CALLBACKS:
+        await handler(q, u, context)
+        return
+    # a double tap would repeat the channel fan-out and edit the same message twice
+    if uid in _busy_users:
+        return
+    _busy_users.add(uid)
+    try:
+        await handler(q, u, context)
+    finally:
+        _busy_users.discard(uid)
+
 
-    if data == "ref_link":
-        link = f"https://t.me/{BOT_USERNAME}?start={uid}"
-        await q.edit_message_text(f"🔗 <b>Your Referral Link</b>\n\n<code>{link}</code>", parse_mode="HTML", reply_markup=user_menu(uid))
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cmu = update.chat_member
+    if not cmu:
         return
+    uid = cmu.new_chat_member.user.id
+    refs = [str(cmu.chat.id)]
+    if cmu.chat.username:
+        refs.append("@" + cmu.chat.username)
+    for ref in refs:
+        evict_member(ref, uid)
+    if cmu.new_chat_member.status in ("left", "kicked"):
+        # the update reached only this worker; the others hold their own cache
+        await db_exec("select pg_notify('member_left', $1)", " ".join([str(uid), *refs]))
 
 
 # =========================================================
 # FastAPI app
 # =========================================================
-app = FastAPI()
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=500)
+app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 tg_app: Optional[Application] = None
 
+# a handler holds at most one pooled connection at a time, so fewer workers
+# than connections keeps a share of the pool free for /api/verify
+UPDATE_WORKERS = max(1, DB_POOL_MAX * 3 // 4)
+UPDATE_QUEUE_MAX = 10_000
+
+UPDATE_DRAIN_TIMEOUT = 8  # seconds; inside a container's usual 10s stop grace period
+
+update_queue: Optional[asyncio.Queue] = None
+update_workers: List[asyncio.Task] = []
+accepting_updates = False
+
 VERIFY_HTML = """<!doctype html>
 <html>
 <head>
@@ -555,94 +1022,111 @@ VERIFY_HTML = """<!doctype html>
     <p id="done" style="display:none;">✅ Done. Go back to Telegram and click <b>Check Verification</b>.</p>
   </div>
 
-<script>
-  const params = new URLSearchParams(window.location.search);
-  const token = params.get("token") || "";
-
-  function getDeviceId(){
-    let id = localStorage.getItem("device_id");
-    if(!id){
-      id = (crypto.randomUUID ? crypto.randomUUID() :
-        'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, c => {
-          const r = Math.random()*16|0, v = c==='x'?r:(r&0x3|0x8);
-          return v.toString(16);
-        })
-      );
-      localStorage.setItem("device_id", id);
-    }
-    return id;
-  }
-
-  document.getElementById("btn").onclick = async () => {
-    const msg = document.getElementById("msg");
-    msg.textContent = "Verifying...";
-    try {
-      const res = await fetch("/api/verify", {
-        method:"POST",
-        headers:{"Content-Type":"application/json"},
-        body: JSON.stringify({ token, device_id: getDeviceId() })
-      });
-      const j = await res.json();
-      if(j.ok){
-        msg.innerHTML = '<span class="ok">✅ '+j.message+'</span>';
-        document.getElementById("done").style.display = "block";
-        document.getElementById("btn").disabled = true;
-      } else {
-        msg.innerHTML = '<span class="bad">❌ '+j.message+'</span>';
-      }
-    } catch(e){
-      msg.innerHTML = '<span class="bad">❌ Network error</span>';
-    }
-  }
-</script>
+<script src="/static/verify.js"></script>
 </body>
 </html>
 """
+VERIFY_BYTES = VERIFY_HTML.encode("utf-8")
+# weak: GZipMiddleware may re-encode the body
+VERIFY_ETAG = 'W/"' + hashlib.md5(VERIFY_BYTES).hexdigest() + '"'
 
 @app.get("/", response_class=PlainTextResponse)
 def health():
     return "OK"
 
 @app.get("/verify", response_class=HTMLResponse)
-def verify_page(token: str = ""):
-    return HTMLResponse(VERIFY_HTML)
+def verify_page(req: Request, token: str = ""):
+    headers = {"ETag": VERIFY_ETAG, "Cache-Control": "public, max-age=3600"}
+    if req.headers.get("if-none-match") == VERIFY_ETAG:
+        return Response(status_code=304, headers=headers)
+    return Response(content=VERIFY_BYTES, media_type="text/html", headers=headers)
 
 @app.post("/api/verify")
 async def api_verify(req: Request):
-    body = await req.json()
+    body = orjson.loads(await req.body())
     token = (body.get("token") or "").strip()
     device_id = (body.get("device_id") or "").strip()
-    ok, message, tg_id = verify_on_web(token, device_id)
-    return JSONResponse({"ok": ok, "message": message, "tg_id": tg_id})
+    ok, message, tg_id = await verify_on_web(token, device_id)
+    return {"ok": ok, "message": message, "tg_id": tg_id}
 
 @app.post("/telegram")
 async def telegram_webhook(req: Request):
-    data = await req.json()
+    if not accepting_updates:
+        # not acked, so Telegram redelivers it to whichever process is up next
+        return ORJSONResponse({"ok": False}, status_code=503)
+    data = orjson.loads(await req.body())
     update = Update.de_json(data, tg_app.bot)  # type: ignore
-    await tg_app.process_update(update)        # type: ignore
-    return JSONResponse({"ok": True})
+    try:
+        update_queue.put_nowait(update)        # type: ignore
+    except asyncio.QueueFull:
+        log.warning("update queue full, dropping update %s", update.update_id)
+    return {"ok": True}
+
+async def update_worker():
+    while True:
+        update = await update_queue.get()  # type: ignore
+        try:
+            await tg_app.process_update(update)  # type: ignore
+        except Exception:
+            log.exception("failed to process update %s", update.update_id)
+        finally:
+            update_queue.task_done()  # type: ignore
 
 async def build_telegram():
-    global tg_app
+    global tg_app, update_queue, accepting_updates, _bot_username
     tg_app = Application.builder().token(BOT_TOKEN).build()
     tg_app.add_handler(CommandHandler("start", start_cmd))
     tg_app.add_handler(CallbackQueryHandler(on_callback))
+    tg_app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.CHAT_MEMBER))
     tg_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
 
     await tg_app.initialize()
-    await tg_app.bot.set_webhook(f"{PUBLIC_BASE_URL}/telegram")
+    _bot_username = tg_app.bot.username  # initialize() already called getMe
+    # every worker runs this; only the first one needs to touch the webhook
+    webhook_url = f"{PUBLIC_BASE_URL}/telegram"
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
+    info = await tg_app.bot.get_webhook_info()
+    if info.url != webhook_url or set(info.allowed_updates or ()) != set(allowed_updates):
+        await tg_app.bot.set_webhook(webhook_url, allowed_updates=allowed_updates)
     await tg_app.start()
 
+    update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_MAX)
+    update_workers.extend(asyncio.create_task(update_worker()) for _ in range(UPDATE_WORKERS))
+    accepting_updates = True
+
 @app.on_event("startup")
 async def on_startup():
+    await ensure_schema()
+    await init_db()
     await build_telegram()
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    global accepting_updates
+    # everything queued was already acked to Telegram; finish it before stopping
+    accepting_updates = False
+    if update_queue is not None:
+        try:
+            await asyncio.wait_for(update_queue.join(), timeout=UPDATE_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning("shutting down with %d queued updates unprocessed", update_queue.qsize())
+    for task in update_workers:
+        task.cancel()
+    await asyncio.gather(*update_workers, return_exceptions=True)
+    update_workers.clear()
     if tg_app:
         await tg_app.stop()
         await tg_app.shutdown()
+    await close_db()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=PORT, log_level="info")
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=PORT,
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
+        log_level="info",
+    )
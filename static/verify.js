@@ -0,0 +1,38 @@
+const params = new URLSearchParams(window.location.search);
+const token = params.get("token") || "";
+
+function getDeviceId(){
+  let id = localStorage.getItem("device_id");
+  if(!id){
+    id = (crypto.randomUUID ? crypto.randomUUID() :
+      'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, c => {
+        const r = Math.random()*16|0, v = c==='x'?r:(r&0x3|0x8);
+        return v.toString(16);
+      })
+    );
+    localStorage.setItem("device_id", id);
+  }
+  return id;
+}
+
+document.getElementById("btn").onclick = async () => {
+  const msg = document.getElementById("msg");
+  msg.textContent = "Verifying...";
+  try {
+    const res = await fetch("/api/verify", {
+      method:"POST",
+      headers:{"Content-Type":"application/json"},
+      body: JSON.stringify({ token, device_id: getDeviceId() })
+    });
+    const j = await res.json();
+    if(j.ok){
+      msg.innerHTML = '<span class="ok">✅ '+j.message+'</span>';
+      document.getElementById("done").style.display = "block";
+      document.getElementById("btn").disabled = true;
+    } else {
+      msg.innerHTML = '<span class="bad">❌ '+j.message+'</span>';
+    }
+  } catch(e){
+    msg.innerHTML = '<span class="bad">❌ Network error</span>';
+  }
+}